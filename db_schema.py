@@ -0,0 +1,27 @@
+# db_schema.py
+# Migrations shared by scrape_posts.py and sentiment_organizer.py; both run from the repo root.
+
+# Denormalized copy of post_tickers so daily aggregation can UNNEST instead of joining.
+POSTS_TICKERS_SQL = """
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS tickers text[];
+CREATE INDEX IF NOT EXISTS idx_posts_tickers ON posts USING gin (tickers);
+UPDATE posts p SET tickers = COALESCE((
+    SELECT array_agg(t.symbol ORDER BY t.symbol)
+    FROM post_tickers pt JOIN tickers t ON t.id = pt.ticker_id
+    WHERE pt.post_id = p.id
+  ), '{}')
+WHERE p.tickers IS NULL;
+"""
+
+def ensure_posts_tickers(cur):
+    """Add and backfill posts.tickers once.
+
+    Checked through information_schema first: the ALTER takes an ACCESS EXCLUSIVE
+    lock and the backfill scans every post, so neither should run on each start.
+    """
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'posts' AND column_name = 'tickers';
+    """)
+    if cur.fetchone() is None:
+        cur.execute(POSTS_TICKERS_SQL)
@@ -1,26 +1,60 @@
-import os, re, json
+import asyncio, csv, io, os, queue, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
-import praw
+import ahocorasick
+import asyncpraw
+from asyncpraw.models import MoreComments
 import psycopg2
 import psycopg2.extras as extras
 from dotenv import load_dotenv
 
+from db_schema import ensure_posts_tickers
+
 load_dotenv(dotenv_path="/Users/leoyang/Downloads/reddit-stock-predictor/apicreds.env")
 
 # --- Config ---
 TARGET_SUBREDDITS = ["stocks", "wallstreetbets", "investing"]
-# Simple pattern; later you can filter against a whitelist of symbols
-TICKER_RE = re.compile(r'\b[A-Z]{1,5}\b')
+MAX_CONCURRENCY = 8  # in-flight Reddit requests; asyncpraw still sleeps on Reddit's rate-limit headers
+FLUSH_EVERY = 25  # submissions per DB batch; writes overlap with the fetches still running
+FLUSH_COMMENTS = 5000  # ...or this many comments, whichever comes first
+COMMENT_CHUNK = 500  # comments per queue item, so big threads stream instead of arriving at once
+QUEUE_SIZE = 4 * MAX_CONCURRENCY  # backpressure so fetched-but-unwritten data stays bounded
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+VALID_TICKERS_CSV = os.path.join(BASE_DIR, "data", "refs", "valid_tickers.csv")  # scripts/ticker_verification.py
+STOP_TICKERS_CSV = os.path.join(BASE_DIR, "stop_tickers.csv")
+
+def load_symbols(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found (run scripts/ticker_verification.py to build it)")
+    with open(path, newline="") as f:
+        return frozenset(row["symbol"].strip().upper() for row in csv.DictReader(f) if row.get("symbol"))
+
+VALID_TICKERS = load_symbols(VALID_TICKERS_CSV)
+STOPWORDS = load_symbols(STOP_TICKERS_CSV)  # real symbols that are usually just words/acronyms
+
+def build_ticker_automaton(symbols):
+    # one Aho-Corasick pass over the text finds every symbol, instead of regex + per-token set probes
+    automaton = ahocorasick.Automaton()
+    for sym in symbols:
+        automaton.add_word(sym, sym)
+    automaton.make_automaton()
+    return automaton
+
+TICKER_AUTOMATON = build_ticker_automaton(VALID_TICKERS - STOPWORDS)
 
 # --- Reddit client ---
-reddit = praw.Reddit(
-    client_id=os.getenv("REDDIT_CLIENT_ID"),
-    client_secret=os.getenv("REDDIT_CLIENT_SECRET"),
-    user_agent=os.getenv("REDDIT_USER_AGENT"),
-)
+# asyncpraw needs a running event loop, so the client is opened inside fetch_all().
+def make_reddit():
+    return asyncpraw.Reddit(
+        client_id=os.getenv("REDDIT_CLIENT_ID"),
+        client_secret=os.getenv("REDDIT_CLIENT_SECRET"),
+        user_agent=os.getenv("REDDIT_USER_AGENT"),
+    )
 
 # --- Postgres conn ---
+# Only the DB writer thread (db_writer) uses this connection.
 conn = psycopg2.connect(
     host=os.getenv("PGHOST", "localhost"),
     port=os.getenv("PGPORT", "5432"),
@@ -30,127 +64,365 @@ conn = psycopg2.connect(
 )
 conn.autocommit = False  # we’ll commit in batches
 
-def upsert_ref(cur, table, unique_col, value):
+# --- COPY staging ---
+# posts/comments rows are COPY'd into TEMP stage tables, then merged with one INSERT ... SELECT.
+# raw_json isn't shipped: the merge builds it from the staged columns with jsonb_build_object.
+POST_COLS = ("reddit_id, subreddit_id, author_id, title, selftext, url, permalink, "
+             "score, num_comments, created_utc, tickers")
+COMMENT_COLS = "reddit_id, post_id, author_id, body, score, created_utc, parent_comment_id"
+
+def _qualified(cols, alias):
+    return ", ".join(f"{alias}.{c.strip()}" for c in cols.split(","))
+
+# raw_json "author" is the bare Reddit name like str(p.author) gave, null for deleted authors
+_RAW_AUTHOR = "NULLIF(substr(a.username, 3), 'deleted')"
+
+# Stage tables are local to this session, so overlapping scraper runs never share them,
+# and ON COMMIT DELETE ROWS empties them when write_batch commits.
+SCHEMA_SQL = f"""
+CREATE TEMP TABLE IF NOT EXISTS posts_stage ON COMMIT DELETE ROWS
+  AS SELECT {POST_COLS} FROM posts WITH NO DATA;
+CREATE TEMP TABLE IF NOT EXISTS comments_stage ON COMMIT DELETE ROWS
+  AS SELECT {COMMENT_COLS} FROM comments WITH NO DATA;
+"""
+
+def ensure_schema():
+    with conn, conn.cursor() as cur:
+        ensure_posts_tickers(cur)
+        cur.execute(SCHEMA_SQL)
+
+# COPY text format: backslash-escape the delimiter/row separators, \N for NULL
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+def _copy_field(v):
+    if v is None:
+        return "\\N"
+    if isinstance(v, datetime):
+        return v.isoformat()
+    if isinstance(v, (set, frozenset)):
+        # text[] literal; symbols are A-Z only, so no element quoting needed
+        return "{" + ",".join(sorted(v)) + "}"
+    return str(v).translate(_COPY_ESCAPES)
+
+def copy_rows(cur, table, cols, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(_copy_field(v) for v in row))
+        buf.write("\n")
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({cols}) FROM STDIN WITH (FORMAT text)", buf)
+
+def upsert_refs(cur, table, unique_col, values):
+    """Upsert a batch of reference values in one statement; returns {value: id}."""
+    values = sorted(set(values))
+    if not values:
+        return {}
     sql = f"""
-    INSERT INTO {table} ({unique_col}) VALUES (%s)
+    INSERT INTO {table} ({unique_col}) VALUES %s
     ON CONFLICT ({unique_col}) DO UPDATE SET {unique_col}=EXCLUDED.{unique_col}
-    RETURNING id;
+    RETURNING id, {unique_col};
     """
-    cur.execute(sql, (value,))
-    return cur.fetchone()[0]
-
-def upsert_post(cur, p, subreddit_id, author_id):
-    sql = """
-    INSERT INTO posts (reddit_id, subreddit_id, author_id, title, selftext, url, permalink,
-                       score, num_comments, created_utc, raw_json)
-    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+    rows = extras.execute_values(cur, sql, [(v,) for v in values], page_size=1000, fetch=True)
+    return {value: ref_id for ref_id, value in rows}
+
+def upsert_ref(cur, table, unique_col, value):
+    return upsert_refs(cur, table, unique_col, [value])[value]
+
+# Process-local id caches: the same authors/symbols repeat constantly across posts and comments.
+_subreddit_cache: dict[str, int] = {}
+_author_cache: dict[str, int] = {}
+_ticker_cache: dict[str, int] = {}
+_post_cache: dict[str, int] = {}  # reddit_id -> id; comments can land in a later batch than their post
+
+def get_ref_ids(cur, table, unique_col, values, cache):
+    """Like upsert_refs, but only round-trips for values not already in cache; returns cache."""
+    missing = {v for v in values if v not in cache}
+    if missing:
+        cache.update(upsert_refs(cur, table, unique_col, missing))
+    return cache
+
+def get_subreddit_ids(cur, names):
+    return get_ref_ids(cur, "subreddits", "name", names, _subreddit_cache)
+
+def get_author_ids(cur, names):
+    return get_ref_ids(cur, "authors", "username", names, _author_cache)
+
+def get_ticker_ids(cur, syms):
+    return get_ref_ids(cur, "tickers", "symbol", syms, _ticker_cache)
+
+def warm_ticker_cache():
+    with conn, conn.cursor() as cur:
+        cur.execute("SELECT symbol, id FROM tickers;")
+        _ticker_cache.update(cur.fetchall())
+
+def post_row(post, subreddit_id, author_id):
+    return (
+        post["reddit_id"], subreddit_id, author_id, post["title"], post["selftext"], post["url"],
+        post["permalink"], post["score"], post["num_comments"], post["created_utc"], post["tickers"]
+    )
+
+def upsert_posts(cur, rows):
+    """COPY post rows (see post_row) into posts_stage and merge.
+
+    Returns ({reddit_id: id}, {reddit_ids that were newly inserted}).
+    """
+    copy_rows(cur, "posts_stage", POST_COLS, rows)
+    cur.execute(f"""
+    INSERT INTO posts ({POST_COLS}, raw_json)
+    SELECT {_qualified(POST_COLS, "s")},
+           jsonb_build_object(
+             'id', s.reddit_id, 'subreddit', sr.name, 'author', {_RAW_AUTHOR},
+             'title', s.title, 'selftext', s.selftext, 'url', s.url,
+             'permalink', s.permalink, 'score', s.score, 'num_comments', s.num_comments
+           )
+    FROM posts_stage s
+    JOIN subreddits sr ON sr.id = s.subreddit_id
+    JOIN authors a     ON a.id = s.author_id
     ON CONFLICT (reddit_id) DO UPDATE SET
       score = EXCLUDED.score,
       num_comments = EXCLUDED.num_comments
-    RETURNING id;
-    """
-    created = datetime.fromtimestamp(p.created_utc, tz=timezone.utc)
-    raw = {
-        "id": p.id, "subreddit": str(p.subreddit), "author": str(p.author),
-        "title": p.title, "selftext": p.selftext, "url": p.url,
-        "permalink": p.permalink, "score": p.score, "num_comments": p.num_comments
-    }
-    cur.execute(sql, (
-        p.id, subreddit_id, author_id, p.title or "", p.selftext or "", p.url or "",
-        p.permalink or "", int(p.score or 0), int(p.num_comments or 0), created, json.dumps(raw)
-    ))
-    return cur.fetchone()[0]
+    RETURNING id, reddit_id, (xmax = 0) AS inserted;
+    """)
+    post_ids, inserted = {}, set()
+    for post_id, reddit_id, is_new in cur.fetchall():
+        post_ids[reddit_id] = post_id
+        if is_new:
+            inserted.add(reddit_id)
+    return post_ids, inserted
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch == "_"
 
 def extract_tickers(text):
-    if not text:
+    # fast path: islower() is a single C-level pass and is True when there's no uppercase
+    # letter at all (most comments), so no symbol can match and the automaton scan is skipped
+    if not text or text.islower():
         return set()
-    # naive: pull ALL 1-5 uppercase tokens; refine later with a real symbol list
-    return set(t for t in TICKER_RE.findall(text) if t.isalpha())
-
-def link_post_tickers(cur, post_id, syms):
-    for sym in syms:
-        tid = upsert_ref(cur, "tickers", "symbol", sym)
-        cur.execute("""
-            INSERT INTO post_tickers (post_id, ticker_id)
-            VALUES (%s, %s) ON CONFLICT DO NOTHING;
-        """, (post_id, tid))
-
-def scrape_subreddit(name, limit=200):
-    print(f"Scraping r/{name}…")
-    with conn, conn.cursor() as cur:
-        subreddit_id = upsert_ref(cur, "subreddits", "name", name)
+    # pad so every match has neighbours; keep only whole-word hits (same as the old \b...\b regex)
+    padded = f" {text} "
+    return {
+        sym for end, sym in TICKER_AUTOMATON.iter(padded)
+        if not _is_word_char(padded[end - len(sym)]) and not _is_word_char(padded[end + 1])
+    }
 
-        # hot() gives a good sample; you can use new(), top(time_filter="day"), etc.
-        for p in reddit.subreddit(name).hot(limit=limit):
-            author_name = f"u_{p.author.name}" if getattr(p.author, "name", None) else "u_deleted"
-            author_id = upsert_ref(cur, "authors", "username", author_name)
+def link_tickers(cur, table, id_col, pairs):
+    # pairs: (post_id or comment_id, ticker_id)
+    if not pairs:
+        return
+    sql = f"""
+    INSERT INTO {table} ({id_col}, ticker_id)
+    VALUES %s ON CONFLICT DO NOTHING;
+    """
+    extras.execute_values(cur, sql, pairs, page_size=1000)
 
-            post_id = upsert_post(cur, p, subreddit_id, author_id)
+def write_batch(posts, comments):
+    """Write buffered post/comment dicts (see post_dict/comment_dict) in one transaction."""
+    # one ON CONFLICT DO UPDATE can't touch the same reddit_id twice; keep the latest copy
+    posts = list({p["reddit_id"]: p for p in posts}.values())
+    comments = list({c["reddit_id"]: c for c in comments}.values())
+    with conn, conn.cursor() as cur:
+        subreddit_ids = get_subreddit_ids(cur, {p["subreddit"] for p in posts})
+        author_ids = get_author_ids(cur, {x["author"] for x in posts + comments})
+        ticker_ids = get_ticker_ids(cur, {s for x in posts + comments for s in x["tickers"]})
 
-            syms = extract_tickers((p.title or "") + " " + (p.selftext or ""))
-            if syms:
-                link_post_tickers(cur, post_id, syms)
+        post_ids, new_posts = upsert_posts(cur, [
+            post_row(p, subreddit_ids[p["subreddit"]], author_ids[p["author"]]) for p in posts
+        ])
+        _post_cache.update(post_ids)
+        comment_ids = upsert_comments(cur, [
+            comment_row(c, _post_cache[c["post_reddit_id"]], author_ids[c["author"]]) for c in comments
+        ])
 
-            scrape_comments_for_post(cur, p, post_id)
+        # re-scraped posts already carry their links (ON CONFLICT only touches score/num_comments)
+        link_tickers(cur, "post_tickers", "post_id", [
+            (post_ids[p["reddit_id"]], ticker_ids[s])
+            for p in posts if p["reddit_id"] in new_posts for s in p["tickers"]
+        ])
+        link_tickers(cur, "comment_tickers", "comment_id", [
+            (comment_ids[c["reddit_id"]], ticker_ids[s]) for c in comments for s in c["tickers"]
+        ])
 
+    print(f"  wrote {len(posts)} posts, {len(comments)} comments")
 
+def comment_row(c, post_id, author_id, parent_comment_id=None):
+    return (
+        c["reddit_id"], post_id, author_id, c["body"], c["score"],
+        c["created_utc"], parent_comment_id
+    )
 
-def upsert_comment(cur, c, post_id, author_id, parent_comment_id=None):
-    sql = """
-    INSERT INTO comments (reddit_id, post_id, author_id, body, score, created_utc, parent_comment_id, raw_json)
-    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
+def upsert_comments(cur, rows):
+    """COPY comment rows (see comment_row) into comments_stage and merge; returns {reddit_id: id}."""
+    copy_rows(cur, "comments_stage", COMMENT_COLS, rows)
+    cur.execute(f"""
+    INSERT INTO comments ({COMMENT_COLS}, raw_json)
+    SELECT {_qualified(COMMENT_COLS, "s")},
+           jsonb_build_object(
+             'id', s.reddit_id, 'post_id', s.post_id, 'author', {_RAW_AUTHOR},
+             'body', s.body, 'score', s.score, 'created_utc', extract(epoch FROM s.created_utc)
+           )
+    FROM comments_stage s
+    JOIN authors a ON a.id = s.author_id
     ON CONFLICT (reddit_id) DO UPDATE SET
       score = EXCLUDED.score
-    RETURNING id;
-    """
-    created = datetime.fromtimestamp(c.created_utc, tz=timezone.utc)
-    raw = {
-        "id": c.id,
-        "post_id": post_id,
-        "author": str(c.author),
-        "body": c.body,
-        "score": c.score,
-        "created_utc": c.created_utc,
+    RETURNING id, reddit_id;
+    """)
+    return {reddit_id: comment_id for comment_id, reddit_id in cur.fetchall()}
+
+# --- Reddit fetching (asyncio; asyncpraw objects never leave these functions) ---
+def post_dict(subreddit, p):
+    return {
+        "reddit_id": p.id,
+        "subreddit": subreddit,
+        "author": "u_" + p.author.name if p.author is not None else "u_deleted",
+        "title": p.title or "",
+        "selftext": p.selftext or "",
+        "url": p.url or "",
+        "permalink": p.permalink or "",
+        "score": int(p.score or 0),
+        "num_comments": int(p.num_comments or 0),
+        "created_utc": datetime.fromtimestamp(p.created_utc, tz=timezone.utc),
+        "tickers": extract_tickers((p.title or "") + " " + (p.selftext or "")),
     }
-    cur.execute(sql, (
-        c.id, post_id, author_id, c.body or "", int(c.score or 0),
-        created, parent_comment_id, json.dumps(raw)
-    ))
-    return cur.fetchone()[0]
 
+def comment_dict(post_reddit_id, c):
+    return {
+        "reddit_id": c.id,
+        "post_reddit_id": post_reddit_id,
+        "author": "u_" + c.author.name if c.author is not None else "u_deleted",
+        "body": c.body or "",
+        "score": int(c.score or 0),
+        "created_utc": datetime.fromtimestamp(c.created_utc, tz=timezone.utc),
+        "tickers": extract_tickers(c.body),
+    }
 
-def scrape_comments_for_post(cur, submission, post_id):
-    """Fetch comments for a submission and store them."""
-    print(f"  Fetching comments for {submission.id} …")
+async def fetch_posts(reddit, sem, name, limit=200):
+    print(f"Scraping r/{name}…")
+    async with sem:
+        subreddit = await reddit.subreddit(name)
+        # hot() gives a good sample; you can use new(), top(time_filter="day"), etc.
+        return [post_dict(name, p) async for p in subreddit.hot(limit=limit)]
+
+async def fetch_comments(reddit, post_reddit_id):
+    """Yield comment dicts for a submission, walking the comment tree breadth-first.
+
+    MoreComments stubs are skipped rather than expanded, same as the old
+    replace_more(limit=0) + list(), but nothing is flattened up front.
+    """
+    print(f"  Fetching comments for {post_reddit_id} …")
+    submission = await reddit.submission(post_reddit_id)
+
+    pending = deque([submission.comments])
+    while pending:
+        forest = pending.popleft()
+        # plain iteration (via __getitem__): CommentForest has no __aiter__ in asyncpraw 8.x
+        for c in forest:
+            if isinstance(c, MoreComments):
+                continue
+            # parent_comment_id: nested linkage skipped for simplicity
+            yield comment_dict(post_reddit_id, c)
+            pending.append(c.replies)
+
+# set by db_writer when a write fails, so producers stop crawling instead of feeding a dead writer
+_writer_failed = threading.Event()
 
-    # Ensure all comments are loaded (avoids 'MoreComments')
-    submission.comments.replace_more(limit=0)
-    comments = submission.comments.list()
+async def put(q, item):
+    # q is the writer's bounded queue.Queue. Poll instead of a blocking put in a thread,
+    # so a producer waiting on a full queue can still be cancelled.
+    while True:
+        if _writer_failed.is_set():
+            raise RuntimeError("db_writer failed; stopping fetches")
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            await asyncio.sleep(0.05)
 
-    for c in comments:
-        author_name = f"u_{c.author.name}" if getattr(c.author, "name", None) else "u_deleted"
-        author_id = upsert_ref(cur, "authors", "username", author_name)
-        parent_comment_id = None
-        if c.parent_id.startswith("t1_"):
-            parent_comment_id = None  # we’ll skip nested linkage for simplicity
+async def fetch_submission(reddit, sem, q, post):
+    # post first, then its comments in COMMENT_CHUNK pieces; the writer keeps queue order
+    async with sem:
+        await put(q, ([post], []))
+        chunk = []
+        async for c in fetch_comments(reddit, post["reddit_id"]):
+            chunk.append(c)
+            if len(chunk) >= COMMENT_CHUNK:
+                await put(q, ([], chunk))
+                chunk = []
+        if chunk:
+            await put(q, ([], chunk))
 
-        comment_id = upsert_comment(cur, c, post_id, author_id, parent_comment_id)
+async def fetch_all(q, subreddits, limit=200):
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    async with make_reddit() as reddit:
+        listings = await asyncio.gather(*(fetch_posts(reddit, sem, name, limit) for name in subreddits))
+        # hot() pagination can return a submission twice when rankings shift between pages
+        unique = {post["reddit_id"]: post for posts in listings for post in posts}
+        tasks = [asyncio.create_task(fetch_submission(reddit, sem, q, post)) for post in unique.values()]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # one fetch failed: stop the rest now rather than leaving them queued behind the writer
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+# --- fan-out / single DB writer ---
+_DONE = object()   # all fetches finished: write what we have
+_ABORT = object()  # a fetch failed: drop the unflushed batch
+
+def db_writer(q):
+    """Drain (posts, comments) items from q and write them on the one psycopg2 connection.
+
+    Flushes every FLUSH_EVERY submissions or FLUSH_COMMENTS comments, so Postgres
+    latency hides behind the Reddit fetches still in flight instead of piling up
+    at the end.
+    """
+    posts, comments = [], []
+    item = None
+    try:
+        while True:
+            item = q.get()
+            if item is _ABORT:
+                return
+            if item is _DONE:
+                break
+            new_posts, new_comments = item
+            posts.extend(new_posts)
+            comments.extend(new_comments)
+            if len(posts) >= FLUSH_EVERY or len(comments) >= FLUSH_COMMENTS:
+                write_batch(posts, comments)
+                posts, comments = [], []
+        if posts or comments:
+            write_batch(posts, comments)
+    except BaseException:
+        _writer_failed.set()
+        # keep draining until scrape_all's sentinel so its put() on the bounded queue can't block
+        while item is not _DONE and item is not _ABORT:
+            item = q.get()
+        raise
 
-        syms = extract_tickers(c.body)
-        if syms:
-            for sym in syms:
-                tid = upsert_ref(cur, "tickers", "symbol", sym)
-                cur.execute("""
-                    INSERT INTO comment_tickers (comment_id, ticker_id)
-                    VALUES (%s, %s) ON CONFLICT DO NOTHING;
-                """, (comment_id, tid))
+def scrape_all(subreddits, limit=200):
+    # Reddit I/O runs concurrently on one event loop; DB writes stay on the single writer thread.
+    q = queue.Queue(maxsize=QUEUE_SIZE)
+    _writer_failed.clear()
+    with ThreadPoolExecutor(max_workers=1) as writer_pool:
+        writer = writer_pool.submit(db_writer, q)
+        try:
+            asyncio.run(fetch_all(q, subreddits, limit))
+        except BaseException:
+            q.put(_ABORT)
+            if _writer_failed.is_set():
+                writer.result()  # surface the DB error rather than the producers' RuntimeError
+            raise
+        q.put(_DONE)
+        writer.result()
 
 
 if __name__ == "__main__":
     try:
-        for s in TARGET_SUBREDDITS:
-            scrape_subreddit(s)
-        conn.commit()
+        ensure_schema()
+        warm_ticker_cache()
+        scrape_all(TARGET_SUBREDDITS)
         print("Done.")
     except Exception as e:
         conn.rollback()
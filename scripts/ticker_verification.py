@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-import csv, os, sys, time
+import csv, os, random, sys, time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 from urllib.request import urlopen, Request
 from urllib.error import URLError, HTTPError
@@ -28,7 +29,9 @@ def fetch(url: str, retries: int = 3, timeout: int = 30) -> List[Dict[str, str]]
         except (URLError, HTTPError, TimeoutError, ValueError) as e:
             last_err = e
             print(f"[fetch][warn] {e}")
-            time.sleep(1 + attempt)
+            if attempt < retries:
+                # exponential backoff with jitter
+                time.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.5))
     raise RuntimeError(f"Failed to fetch {url}: {last_err}")
 
 def normalize_symbol(sym: str) -> str:
@@ -48,8 +51,10 @@ def build(out_csv: str):
     print(f"[build] output -> {out_csv}")
     os.makedirs(os.path.dirname(out_csv), exist_ok=True)
     all_rows = []
-    for name, url in SRC.items():
-        rows = fetch(url)
+    # both listings download concurrently; results come back in SRC order
+    with ThreadPoolExecutor(max_workers=len(SRC)) as ex:
+        results = list(ex.map(fetch, SRC.values()))
+    for name, rows in zip(SRC, results):
         print(f"[build] {name}: {len(rows)} raw rows")
         all_rows.extend(rows)
 
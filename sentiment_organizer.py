@@ -1,14 +1,23 @@
 # phase2_sentiment.py
+import argparse
+import fcntl
 import os
+import sys
+from multiprocessing import Pool
+
+import numpy as np
 import pandas as pd
 from datetime import datetime, timezone, timedelta
 
-import psycopg2
 import psycopg2.extras as extras
+from psycopg2.pool import ThreadedConnectionPool
 
 from nltk.sentiment import SentimentIntensityAnalyzer
 
 from dotenv import load_dotenv
+
+from db_schema import ensure_posts_tickers
+
 load_dotenv(dotenv_path="/Users/leoyang/Downloads/reddit-stock-predictor/apicreds.env")
 
 PG_CONN_KW = dict(
@@ -21,57 +30,170 @@ PG_CONN_KW = dict(
 
 USE_FINBERT = False  # flip True to run FinBERT
 FINBERT_MODEL = "ProsusAI/finbert"
+FINBERT_BATCH_SIZE = 32
+FINBERT_MAX_LEN = 256  # tokens
+VADER_PROCESSES = os.cpu_count() or 1
+VADER_POOL_MIN = 5000  # below this, worker startup costs more than it saves
+FETCH_CHUNK = 5000  # rows per server-side cursor fetch / score / upsert round
 
 # ---------- DB helpers ----------
+# Reuse connections instead of paying connect + auth on every get_conn();
+# point PGHOST/PGPORT at PgBouncer (see README) to share them across runs too.
+_POOL = None
+
+def _get_pool():
+    global _POOL
+    if _POOL is None:
+        _POOL = ThreadedConnectionPool(1, 10, **PG_CONN_KW)
+    return _POOL
+
 def get_conn():
-    return psycopg2.connect(**PG_CONN_KW)
+    return _get_pool().getconn()
+
+def put_conn(conn):
+    _get_pool().putconn(conn)
+
+# Indexes backing the scoring queries. The NOT EXISTS anti-joins already probe the
+# unique post_sentiment(post_id) / comment_sentiment(comment_id) keys the upserts use;
+# the rescore branch filters on created_utc. daily_sentiment.updated_at / scored_at
+# drive the incremental rollup in aggregate_daily.
+# posts.tickers (+ backfill) mirrors scrape_posts.SCHEMA_SQL, since AGG_SQL reads it and
+# this script may run before the first scrape after an upgrade.
+SCHEMA_SQL = """
+CREATE INDEX IF NOT EXISTS idx_posts_created_utc    ON posts (created_utc);
+CREATE INDEX IF NOT EXISTS idx_comments_created_utc ON comments (created_utc);
+CREATE INDEX IF NOT EXISTS idx_post_sentiment_scored_at    ON post_sentiment (scored_at);
+CREATE INDEX IF NOT EXISTS idx_comment_sentiment_scored_at ON comment_sentiment (scored_at);
+ALTER TABLE daily_sentiment ADD COLUMN IF NOT EXISTS updated_at timestamptz;
+CREATE TABLE IF NOT EXISTS daily_sentiment_watermark (
+  id             boolean PRIMARY KEY DEFAULT TRUE CHECK (id),  -- single row
+  scored_through timestamptz NOT NULL
+);
+"""
+
+def ensure_schema(conn):
+    with conn, conn.cursor() as cur:
+        ensure_posts_tickers(cur)
+        cur.execute(SCHEMA_SQL)
 
 # Pull unscored (or to-be-rescored) items
 POSTS_SQL = """
-SELECT p.id, p.score, p.created_utc, COALESCE(p.title,'') || ' ' || COALESCE(p.selftext,'') AS text
+SELECT p.id, p.score, p.created_utc, p.title, p.selftext
 FROM posts p
-LEFT JOIN post_sentiment s ON s.post_id = p.id
 WHERE (%(rescore)s = TRUE AND p.created_utc >= %(since)s)
-   OR (%(rescore)s = FALSE AND s.post_id IS NULL)
+   OR (%(rescore)s = FALSE AND NOT EXISTS (SELECT 1 FROM post_sentiment s WHERE s.post_id = p.id))
 """
 
 COMMENTS_SQL = """
 SELECT c.id, c.score, c.created_utc, COALESCE(c.body,'') AS text
 FROM comments c
-LEFT JOIN comment_sentiment s ON s.comment_id = c.id
 WHERE (%(rescore)s = TRUE AND c.created_utc >= %(since)s)
-   OR (%(rescore)s = FALSE AND s.comment_id IS NULL)
+   OR (%(rescore)s = FALSE AND NOT EXISTS (SELECT 1 FROM comment_sentiment s WHERE s.comment_id = c.id))
 """
 
-def fetch_for_scoring(conn, table: str, rescore=False, since_days=14) -> pd.DataFrame:
+def iter_for_scoring(conn, table: str, rescore=False, since_days=14):
+    """Stream rows to score as DataFrames of up to FETCH_CHUNK rows via a server-side cursor."""
     params = {"rescore": rescore, "since": datetime.now(tz=timezone.utc) - timedelta(days=since_days)}
     sql = POSTS_SQL if table == "posts" else COMMENTS_SQL
-    return pd.read_sql(sql, conn, params=params)
+    with conn.cursor(name=f"score_{table}") as cur:
+        cur.itersize = FETCH_CHUNK
+        cur.execute(sql, params)
+        for rows in iter(lambda: cur.fetchmany(FETCH_CHUNK), []):
+            df = pd.DataFrame(rows, columns=[d[0] for d in cur.description])
+            if table == "posts":
+                # concatenated client-side (vectorized) instead of per row in Postgres
+                df["text"] = df["title"].fillna("") + " " + df["selftext"].fillna("")
+            yield df
 
 # ---------- VADER ----------
 _vader = SentimentIntensityAnalyzer()
+VADER_COLS = ["vader_pos", "vader_neg", "vader_neu", "vader_compound"]
 
-def score_vader(texts):
-    # returns dicts with pos/neg/neu/compound
-    return [_vader.polarity_scores(t or "") for t in texts]
+def _vader_scores(t):
+    # module-level so Pool workers only get the text, not a pickled analyzer
+    s = _vader.polarity_scores(t or "")
+    return s["pos"], s["neg"], s["neu"], s["compound"]
+
+# One worker pool per process, created on first big batch. Spawned workers (macOS default)
+# re-import this module, so a pool per FETCH_CHUNK would pay that startup on every chunk.
+_VADER_POOL = None
+
+def _get_vader_pool():
+    global _VADER_POOL
+    if _VADER_POOL is None and VADER_PROCESSES > 1:
+        _VADER_POOL = Pool(VADER_PROCESSES)
+    return _VADER_POOL
+
+def close_vader_pool():
+    global _VADER_POOL
+    if _VADER_POOL is not None:
+        _VADER_POOL.close()
+        _VADER_POOL.join()
+        _VADER_POOL = None
+
+def score_vader(texts, pool=None):
+    # returns an (n, 4) array of pos/neg/neu/compound
+    # VADER is pure Python and embarrassingly parallel, so big batches go across cores
+    if pool is not None:
+        return np.array(pool.map(_vader_scores, texts, chunksize=256), dtype=np.float64)
+    arr = np.empty((len(texts), 4), dtype=np.float64)
+    for i, t in enumerate(texts):
+        arr[i] = _vader_scores(t)
+    return arr
 
 # ---------- FinBERT (optional) ----------
-_pipeline = None
-def score_finbert(texts):
-    global _pipeline
-    if _pipeline is None:
-        from transformers import AutoTokenizer, AutoModelForSequenceClassification, TextClassificationPipeline
+_finbert = None  # (tokenizer, model, device), loaded on first use
+def _load_finbert():
+    global _finbert
+    if _finbert is None:
+        import torch
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification
+        # GPU + FP16 when available; FP16 on CPU is slower than FP32, so keep FP32 there
+        on_gpu = torch.cuda.is_available()
+        device = torch.device("cuda" if on_gpu else "cpu")
         tok = AutoTokenizer.from_pretrained(FINBERT_MODEL)
-        mdl = AutoModelForSequenceClassification.from_pretrained(FINBERT_MODEL)
-        _pipeline = TextClassificationPipeline(model=mdl, tokenizer=tok, truncation=True, max_length=256, device=-1)
-    preds = _pipeline(list(texts))
-    # map to signed
-    out = []
-    for p in preds:
-        label = p["label"].lower()
-        conf = float(p["score"])
-        signed = {"positive": 1.0, "neutral": 0.0, "negative": -1.0}.get(label, 0.0) * conf
-        out.append((label, conf, signed))
+        mdl = AutoModelForSequenceClassification.from_pretrained(
+            FINBERT_MODEL, torch_dtype=torch.float16 if on_gpu else torch.float32
+        ).to(device).eval()
+        _finbert = (tok, mdl, device)
+    return _finbert
+
+def encode_finbert(texts):
+    """Tokenize once for FinBERT; returns (encodings, truncated_texts).
+
+    truncated_texts are the original strings cut where FinBERT's 256-token window
+    ends (via offsets, so case and punctuation survive for VADER).
+    """
+    tok, _, _ = _load_finbert()
+    texts = [t or "" for t in texts]
+    enc = tok(texts, truncation=True, max_length=FINBERT_MAX_LEN, return_offsets_mapping=True)
+    truncated = []
+    for t, ids, offsets in zip(texts, enc["input_ids"], enc.pop("offset_mapping")):
+        if len(ids) < FINBERT_MAX_LEN:
+            truncated.append(t)
+        else:
+            truncated.append(t[:max(e for _, e in offsets)])
+    return enc, truncated
+
+def score_finbert(enc):
+    import torch
+    tok, mdl, device = _load_finbert()
+    keys = list(enc.keys())
+    n = len(enc["input_ids"])
+    # run in length order so each batch pads to similar lengths, then restore input order
+    order = sorted(range(n), key=lambda i: len(enc["input_ids"][i]))
+    out = [None] * n
+    with torch.inference_mode():
+        for start in range(0, n, FINBERT_BATCH_SIZE):
+            idx = order[start:start + FINBERT_BATCH_SIZE]
+            batch = tok.pad({k: [enc[k][i] for i in idx] for k in keys}, return_tensors="pt").to(device)
+            probs = torch.softmax(mdl(**batch).logits.float(), dim=-1)
+            confs, label_ids = probs.max(dim=-1)
+            for i, conf, label_id in zip(idx, confs.tolist(), label_ids.tolist()):
+                # map to signed
+                label = mdl.config.id2label[label_id].lower()
+                signed = {"positive": 1.0, "neutral": 0.0, "negative": -1.0}.get(label, 0.0) * conf
+                out[i] = (label, conf, signed)
     return out
 
 # ---------- bulk upserts ----------
@@ -109,22 +231,22 @@ def upsert_comment_sentiment(cur, rows):
     extras.execute_values(cur, sql, rows, page_size=1000)
 
 # ---------- main scoring routines ----------
-def score_table(conn, table: str, use_finbert=False, rescore=False):
-    df = fetch_for_scoring(conn, table, rescore=rescore)
-    if df.empty:
-        print(f"[{table}] nothing to score.")
-        return 0
+SENTIMENT_COLS = ["id", *VADER_COLS, "finbert_label", "finbert_conf", "finbert_signed"]
+
+def score_chunk(df: pd.DataFrame, use_finbert=False):
+    """Score one chunk; returns rows for upsert_post_sentiment / upsert_comment_sentiment."""
+    texts = df["text"].tolist()
+    if use_finbert:
+        # tokenize once: FinBERT runs on the encodings, VADER on the same truncated window
+        enc, texts = encode_finbert(texts)
 
     # VADER
-    v = score_vader(df["text"])
-    df["vader_pos"] = [d["pos"] for d in v]
-    df["vader_neg"] = [d["neg"] for d in v]
-    df["vader_neu"] = [d["neu"] for d in v]
-    df["vader_compound"] = [d["compound"] for d in v]
+    pool = _get_vader_pool() if len(texts) >= VADER_POOL_MIN else None
+    df[VADER_COLS] = score_vader(texts, pool=pool)
 
     # FinBERT (optional)
     if use_finbert:
-        labels, confs, signed = zip(*score_finbert(df["text"]))
+        labels, confs, signed = zip(*score_finbert(enc))
         df["finbert_label"] = labels
         df["finbert_conf"]  = confs
         df["finbert_signed"]= signed
@@ -133,44 +255,66 @@ def score_table(conn, table: str, use_finbert=False, rescore=False):
         df["finbert_conf"]  = None
         df["finbert_signed"]= None
 
-    tuples = []
-    if table == "posts":
-        tuples = list(
-            zip(df["id"], df["vader_pos"], df["vader_neg"], df["vader_neu"], df["vader_compound"],
-                df["finbert_label"], df["finbert_conf"], df["finbert_signed"])
-        )
-        with conn, conn.cursor() as cur:
-            upsert_post_sentiment(cur, tuples)
-    else:
-        tuples = list(
-            zip(df["id"], df["vader_pos"], df["vader_neg"], df["vader_neu"], df["vader_compound"],
-                df["finbert_label"], df["finbert_conf"], df["finbert_signed"])
-        )
-        with conn, conn.cursor() as cur:
-            upsert_comment_sentiment(cur, tuples)
+    # tolist() hands psycopg2 plain Python ints/floats rather than numpy scalars
+    return list(zip(*(df[col].tolist() for col in SENTIMENT_COLS)))
+
+def score_table(conn, table: str, use_finbert=False, rescore=False):
+    upsert = upsert_post_sentiment if table == "posts" else upsert_comment_sentiment
+    n = 0
+    # stream, score and upsert chunk by chunk in one transaction (the named cursor lives until commit)
+    with conn, conn.cursor() as cur:
+        for df in iter_for_scoring(conn, table, rescore=rescore):
+            tuples = score_chunk(df, use_finbert=use_finbert)
+            upsert(cur, tuples)
+            n += len(tuples)
 
-    print(f"[{table}] scored {len(tuples)} rows.")
-    return len(tuples)
+    if n == 0:
+        print(f"[{table}] nothing to score.")
+        return 0
+    print(f"[{table}] scored {n} rows.")
+    return n
 
 # ---------- daily aggregation ----------
 AGG_SQL = """
 -- Aggregate post sentiment + comment sentiment by ticker + UTC date (weighted by score).
-WITH post_s AS (
-  SELECT pt.ticker_id, t.symbol AS ticker,
-         (p.created_utc AT TIME ZONE 'UTC')::date AS d,
+-- Only dates with sentiment scored since the last run are recomputed, unless full refresh.
+-- %(since)s is the stored watermark: the newest scored_at the previous run actually saw.
+-- It is passed in as a literal so the planner sizes touched from the scored_at index.
+WITH touched AS (
+  SELECT (p.created_utc AT TIME ZONE 'UTC')::date AS d
+  FROM post_sentiment ps
+  JOIN posts p ON p.id = ps.post_id
+  WHERE %(full)s OR ps.scored_at > %(since)s
+  UNION
+  SELECT (c.created_utc AT TIME ZONE 'UTC')::date AS d
+  FROM comment_sentiment cs
+  JOIN comments c ON c.id = cs.comment_id
+  WHERE %(full)s OR cs.scored_at > %(since)s
+),
+-- half-open UTC ranges, so post_s/comment_s can seek idx_*_created_utc per touched day
+days AS (
+  SELECT d,
+         d::timestamp AT TIME ZONE 'UTC'       AS lo,
+         (d + 1)::timestamp AT TIME ZONE 'UTC' AS hi
+  FROM touched
+),
+post_s AS (
+  SELECT pt.symbol AS ticker,
+         dy.d,
          COALESCE(ps.finbert_signed, ps.vader_compound) AS s,
          GREATEST(p.score, 0) AS w
-  FROM posts p
-  JOIN post_tickers pt   ON pt.post_id = p.id
-  JOIN tickers t         ON t.id = pt.ticker_id
+  FROM days dy
+  JOIN posts p           ON p.created_utc >= dy.lo AND p.created_utc < dy.hi
+  CROSS JOIN LATERAL UNNEST(p.tickers) AS pt(symbol)
   JOIN post_sentiment ps ON ps.post_id = p.id
 ),
 comment_s AS (
   SELECT ct.ticker_id, t.symbol AS ticker,
-         (c.created_utc AT TIME ZONE 'UTC')::date AS d,
+         dy.d,
          COALESCE(cs.finbert_signed, cs.vader_compound) AS s,
          GREATEST(c.score, 0) AS w
-  FROM comments c
+  FROM days dy
+  JOIN comments c           ON c.created_utc >= dy.lo AND c.created_utc < dy.hi
   JOIN comment_tickers ct   ON ct.comment_id = c.id
   JOIN tickers t            ON t.id = ct.ticker_id
   JOIN comment_sentiment cs ON cs.comment_id = c.id
@@ -187,31 +331,75 @@ rolled AS (
          SUM(w) AS weight_sum
   FROM union_s
   GROUP BY ticker, date
+),
+upserted AS (
+  INSERT INTO daily_sentiment (ticker, date, sentiment, count, weight_sum, updated_at)
+  SELECT ticker, date, sentiment, count, weight_sum, now()
+  FROM rolled
+  ON CONFLICT (ticker, date)
+  DO UPDATE SET
+    sentiment  = EXCLUDED.sentiment,
+    count      = EXCLUDED.count,
+    weight_sum = EXCLUDED.weight_sum,
+    updated_at = EXCLUDED.updated_at
+  RETURNING 1
+),
+seen AS (
+  SELECT GREATEST((SELECT MAX(scored_at) FROM post_sentiment),
+                  (SELECT MAX(scored_at) FROM comment_sentiment)) AS ts
+),
+mark AS (
+  INSERT INTO daily_sentiment_watermark (id, scored_through)
+  SELECT TRUE, ts FROM seen WHERE ts IS NOT NULL
+  ON CONFLICT (id) DO UPDATE SET
+    scored_through = GREATEST(daily_sentiment_watermark.scored_through, EXCLUDED.scored_through)
 )
-INSERT INTO daily_sentiment (ticker, date, sentiment, count, weight_sum)
-SELECT ticker, date, sentiment, count, weight_sum
-FROM rolled
-ON CONFLICT (ticker, date)
-DO UPDATE SET
-  sentiment  = EXCLUDED.sentiment,
-  count      = EXCLUDED.count,
-  weight_sum = EXCLUDED.weight_sum;
+SELECT COUNT(*) FROM upserted;
 """
 
-def aggregate_daily(conn):
+def aggregate_daily(conn, full_refresh=False):
+    # incremental by default; full_refresh also picks up score (weight) changes from re-scrapes
     with conn, conn.cursor() as cur:
-        cur.execute(AGG_SQL)
-    print("[daily] aggregated.")
+        cur.execute("SELECT scored_through FROM daily_sentiment_watermark;")
+        row = cur.fetchone()
+        since = row[0] if row else datetime(1970, 1, 1, tzinfo=timezone.utc)
+        cur.execute(AGG_SQL, {"full": full_refresh, "since": since})
+        n = cur.fetchone()[0]
+    print(f"[daily] aggregated {n} ticker-days{' (full refresh)' if full_refresh else ''}.")
 
 # ---------- CLI entry ----------
+# scored_at is the scoring transaction's start time and score_table is one long
+# transaction, so a scoring run still open while another run aggregates could commit
+# rows older than the watermark. Runs on this host are serialized with a lock file;
+# schedule runs on other hosts so they don't overlap.
+RUN_LOCK = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".sentiment_organizer.lock")
+
+def acquire_run_lock():
+    f = open(RUN_LOCK, "w")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        sys.exit("[lock] another sentiment_organizer run is in progress; exiting.")
+    return f
+
 if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Score Reddit posts/comments and roll up daily sentiment.")
+    ap.add_argument("--full-refresh", action="store_true", help="recompute every day in daily_sentiment")
+    args = ap.parse_args()
+
+    run_lock = acquire_run_lock()  # held until the process exits
     conn = get_conn()
     try:
+        ensure_schema(conn)
+
         # Score new/unscored rows (set rescore=True to refresh last N days)
-        score_table(conn, "posts",   use_finbert=USE_FINBERT, rescore=False)
-        score_table(conn, "comments",use_finBERT:=USE_FINBERT, rescore=False)  # py>=3.8 ok with walrus
+        score_table(conn, "posts",    use_finbert=USE_FINBERT, rescore=False)
+        score_table(conn, "comments", use_finbert=USE_FINBERT, rescore=False)
 
         # Build/refresh daily rollups
-        aggregate_daily(conn)
+        aggregate_daily(conn, full_refresh=args.full_refresh)
     finally:
-        conn.close()
+        close_vader_pool()
+        put_conn(conn)
+        _get_pool().closeall()